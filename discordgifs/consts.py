@@ -1,4 +1,5 @@
 from dataclasses import dataclass
+from fractions import Fraction
 
 @dataclass(frozen=True)
 class OutputSize:
@@ -15,4 +16,4 @@ class InitialFrameSize:
     BANNER = 800, 320
     PFP = 500, 500
 
-BANNER_RATIO = 1, 0.4
+BANNER_RATIO = 1, Fraction(2, 5)
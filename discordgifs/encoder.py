@@ -1,15 +1,45 @@
+import glob
+import json
+import logging
+import math
 import os
 import re
+import shlex
 import subprocess
-import sys
+import tempfile
+import time
 from abc import ABC, abstractmethod
-from typing import Tuple
+from functools import lru_cache
+from string import digits
+from typing import Dict, List, Optional, Tuple
 
 import ffmpeg_cmds
 from encoding_info import EncodingInfo
-from utils import get_available_name
+from probe_cache import ProbeCache
+from utils import get_available_name, remove_path, user_cache_dir
 
-show_commands = True
+log = logging.getLogger(__name__)
+
+# matroska only stores the container duration, so ask for it as well
+PROBE_FIELDS = "stream=width,height,codec_name,r_frame_rate,duration"
+PROBE_FIELDS += ":format=duration"
+# headers nearly always hold these, so try reading as little as possible first
+_QUICK_PROBE = ["-probesize", "32", "-analyzeduration", "0"]
+# bump when the probe changes in a way PROBE_FIELDS doesn't show, so entries
+# cached by older versions are probed again
+_PROBE_VERSION = 4
+probe_cache = ProbeCache(
+    os.path.join(user_cache_dir(), "probe_cache.json"),
+    f"{_PROBE_VERSION}:{PROBE_FIELDS}",
+)
+
+# RAM backed on most linux systems but often small, e.g. in containers
+_SCRATCH_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+# seconds between output size checks on commands with a size cap
+_SIZE_POLL = 0.1
+
+_VERSION_RE = re.compile(r"(\d+)\.(\d+)")
 
 
 class Encoder(ABC):
@@ -29,149 +59,319 @@ class Encoder(ABC):
         cls,
         inp: str,
         output_fps: int,
-        show_command: bool = True,
     ) -> str:
         """Create video from a png sequence. Return full path of the video."""
         dirname = os.path.dirname(inp)
         filename = os.path.basename(inp)
-        out = re.sub(r"\d{1,6}$", "", os.path.splitext(filename)[0]) + ".mp4"
+        out = os.path.splitext(filename)[0].rstrip(digits) + ".mkv"
         out = os.path.join(dirname, out)
         out = get_available_name(out)
 
         cmd = ffmpeg_cmds.png_to_video(filename, dirname, output_fps, out)
-        Encoder._run_cmd(cmd, show_command)
+        Encoder._run_cmd(cmd)
         return out
 
     @classmethod
-    def video_to_png(
-        cls, einfo: EncodingInfo, show_command: bool = True
-    ) -> str:
+    def video_to_png(cls, einfo: EncodingInfo) -> str:
         """Create png sequence from the source video for gifski.
         Return full path of the folder."""
-        dirname = os.path.dirname(einfo.iname)
-        folder = get_available_name(os.path.join(dirname, "frames"))
-        os.mkdir(folder)
+        scratch = cls._frames_dir(einfo)
+        # other encodes share /dev/shm and can fill it after the space check,
+        # so retry on disk if extracting there fails
+        dirs = [None] if scratch is None else [scratch, None]
+        for dir_ in dirs:
+            # mkdtemp so encodes running in parallel never share a folder
+            folder = tempfile.mkdtemp(prefix="frames", dir=dir_)
+            cmd = ffmpeg_cmds.video_to_png(
+                einfo.iname, einfo.fps, folder, einfo.crop_rect
+            )
+            if Encoder._run_cmd(cmd) == 0:
+                einfo.iname = os.path.join(folder, "frame*.png")
+                return folder
+            # a partial sequence would make a short gif
+            remove_path(folder)
+        raise RuntimeError(f"Could not extract frames from {einfo.iname}")
 
-        cmd = ffmpeg_cmds.video_to_png(einfo.iname, einfo.fps, folder)
-        Encoder._run_cmd(cmd, show_command)
-        einfo.iname = os.path.join(folder, "frame*.png")
-        return folder
+    @classmethod
+    def _frames_dir(cls, einfo: EncodingInfo) -> Optional[str]:
+        """
+        Frames are only needed until gifski is done, so keep them in memory
+        if they fit with room to spare. None means the regular temp dir
+        """
+        if _SCRATCH_DIR is None:
+            return None
+        try:
+            frames = Encoder.get_duration(einfo.iname) * einfo.fps
+            st = os.statvfs(_SCRATCH_DIR)
+        except (KeyError, ValueError, OSError):
+            return None
+        # low compression pngs are rarely bigger than the raw rgb frames
+        needed = einfo.iwidth * einfo.iheight * 3 * frames
+        if needed > st.f_bavail * st.f_frsize // 2:
+            return None
+        return _SCRATCH_DIR
 
     @classmethod
     def crop(cls, inp: str, w: int, h: int, x: int, y: int) -> str:
         """Crop the video. Return full path of the cropped video."""
         cmd, out = ffmpeg_cmds.crop(inp, w, h, x, y)
-        Encoder._run_cmd(cmd, show_commands)
+        Encoder._run_cmd(cmd)
         return out
 
+    @classmethod
+    def probe_all(cls, tar: str) -> Dict[str, str]:
+        """
+        Return the stream values needed for encoding for target from a single
+        ffprobe call, probing again in full if the headers were not enough.
+        Results are cached across runs until the target is modified
+        """
+        values = probe_cache.get(tar)
+        if values is None:
+            values = cls._ffprobe(tar, PROBE_FIELDS, quick=True)
+            if not _quick_probe_ok(values):
+                values = cls._ffprobe(tar, PROBE_FIELDS)
+            if values:
+                probe_cache.put(tar, values)
+        return values
+
     @classmethod
     def get_dimensions(cls, tar: str) -> Tuple[int, int]:
         """Return video width,height for target"""
-        fout = Encoder._ffprobe(tar, "width,height")
-        iwidth, iheight = fout.split()
-        return int(iwidth), int(iheight)
+        probe = Encoder.probe_all(tar)
+        return int(probe["width"]), int(probe["height"])
 
     @classmethod
     def get_duration(cls, tar: str) -> float:
         """Return video duration for target"""
-        fout = Encoder._ffprobe(tar, "duration")
-        return float(fout)
+        return float(Encoder.probe_all(tar)["duration"])
 
     @classmethod
     def get_fps(cls, tar: str) -> float:
         """Return video fps for target"""
-        fout = Encoder._ffprobe(tar, "r_frame_rate")
-        frames, seconds = fout.split("/")
+        return Encoder.parse_fps(Encoder.probe_all(tar)["r_frame_rate"])
+
+    @staticmethod
+    def parse_fps(r_frame_rate: str) -> float:
+        """Return fps from an ffprobe frame rate such as 30000/1001"""
+        frames, seconds = r_frame_rate.split("/")
         return round(float(float(frames) / float(seconds)), 3)
 
     @classmethod
     def get_codec(cls, tar: str) -> str:
         """Return video codec for target"""
-        return Encoder._ffprobe(tar, "codec_name")
+        return Encoder.probe_all(tar)["codec_name"]
 
-    @abstractmethod
     def encode(self) -> str:
         """
         Encode gif until it's the maximum size it can be within the size limit
         using ffmpeg or gifski
         """
-        raise NotImplementedError("encode must be implemented")
+        einfo = self.einfo
+        search = WidthSearch(einfo)
+        # width -> trial output. only the best one so far is kept on disk
+        self.trials: Dict[int, str] = dict()
+        self.owidth = 0
+        try:
+            widths = search.next_widths()
+            while widths:
+                # no need to encode to know these widths are too big
+                for w in [w for w in widths if einfo.max_width_check(w)]:
+                    search.update(w, fits=False)
+                    widths.remove(w)
+                if not widths:
+                    widths = search.next_widths()
+                    continue
+
+                size_is_within_range = False
+                encoded = self._encode_widths(widths)
+                self.trials.update(encoded)
+                for w, trial in sorted(encoded.items()):
+                    size = os.path.getsize(trial)
+                    # trials are created empty, so this means nothing was
+                    # written. never let it become the output
+                    if size == 0:
+                        raise RuntimeError(
+                            f"Encoding {einfo.iname} at width {w} wrote nothing"
+                        )
+                    log.info("size: %dKB", size // 1024)
+                    search.update(w, fits=size < einfo.osize_limit, size=size)
+                    size_is_within_range |= (
+                        einfo.osize_limit * einfo.osize_range
+                        < size
+                        < einfo.osize_limit
+                    )
+                self._prune_trials(search)
+                if size_is_within_range:
+                    break
+                widths = search.next_widths()
+
+            if self.trials:
+                width = self.owidth = self._best_trial(search)
+                self._finalize(width, self.trials.pop(width))
+        finally:
+            for trial in self.trials.values():
+                os.remove(trial)
+        return einfo.oname
+
+    @abstractmethod
+    def _encode_widths(self, widths: List[int]) -> Dict[int, str]:
+        """Encode a trial output for each width. Return width to trial path"""
+        raise NotImplementedError("_encode_widths must be implemented")
+
+    def _finalize(self, width: int, trial: str):
+        """Make the chosen trial the output"""
+        os.replace(trial, self.einfo.oname)
+
+    def _raise_failed(self, tool: str, trials: Dict[int, str]):
+        """Remove the trials of a failed run and report it"""
+        for trial in trials.values():
+            os.remove(trial)
+        raise RuntimeError(f"{tool} failed on {self.einfo.iname}")
+
+    def _new_trial(self) -> str:
+        """Return a new empty file next to the output for a trial encode"""
+        dirname, basename = os.path.split(self.einfo.oname)
+        fd, trial = tempfile.mkstemp(
+            prefix=".trial",
+            suffix=os.path.splitext(basename)[1],
+            dir=dirname or None,
+        )
+        os.close(fd)
+        return trial
+
+    def _best_trial(self, search: "WidthSearch") -> int:
+        """
+        Largest width that fit within the size limit. If none did, fall back
+        to the smallest width tried
+        """
+        return search.lo if search.lo in self.trials else min(self.trials)
+
+    def _prune_trials(self, search: "WidthSearch"):
+        if not self.trials:
+            return
+        best = self._best_trial(search)
+        for w in [w for w in self.trials if w != best]:
+            os.remove(self.trials.pop(w))
+
+    @classmethod
+    def assign_output_names(cls, einfos: List[EncodingInfo]):
+        """
+        Give every einfo an output name that is neither in use nor taken by
+        another einfo in the list. Call before encoding them in parallel
+        """
+        taken: List[str] = list()
+        for einfo in einfos:
+            einfo.oname = get_available_name(einfo.oname, reserved=taken)
+            taken.append(einfo.oname)
 
     @classmethod
     def create_einfo(
         cls, filename: str, fps, output_type: str
     ) -> EncodingInfo:
-        codec = cls.get_codec(filename)
-        iwidth, iheight = cls.get_dimensions(filename)
+        probe = cls.probe_all(filename)
         return EncodingInfo.new(
-            filename, iwidth, iheight, codec, output_type, fps
+            filename,
+            int(probe["width"]),
+            int(probe["height"]),
+            probe["codec_name"],
+            output_type,
+            fps,
         )
 
     @classmethod
     def preview(cls, video: str):
         """Preview the video"""
         cmd = ffmpeg_cmds.ffplay_preview(video)
-        proc = subprocess.Popen(cmd, shell=True)
+        proc = subprocess.Popen(cmd)
         return proc
 
-    def _wsize_and_mul(self, size: int, old_width: int, mul: float):
-        """
-        Reduce or increase width based on file size and frame size that
-        resulted from the old_width. This new_width will be used to calculate
-        height as well. Return new_width
-        """
-        video_is_out_of_bounds = self.einfo.max_width_check(old_width)
-
-        if size >= self.einfo.osize_limit or video_is_out_of_bounds:
-            return self._get_reduced_size(
-                old_width, mul, video_is_out_of_bounds
-            )
-        else:
-            return self._get_increased_size(old_width, mul)
-
-    def _get_reduced_size(
-        self,
-        old_width: int,
-        mul: float,
-        video_is_out_of_bounds: bool,
-    ):
-        if mul > 0 or video_is_out_of_bounds:
-            if mul > 0:
-                mul = mul / 2
-                mul *= -1
-        new_width = old_width * (1 + mul)
-        new_width = int(new_width)
-        return new_width, mul
-
-    def _get_increased_size(
-        self,
-        old_width: int,
-        mul: float,
-    ):
-        if mul < 0:
-            mul = mul / 2
-            mul *= -1
-        new_width = old_width * (1 + mul)
-        new_width = int(new_width)
-        return new_width, mul
+    @classmethod
+    def _run_cmd(cls, cmd: List[str]) -> int:
+        """Run cmd and return its exit code"""
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(shlex.join(cmd))
+        return subprocess.run(cmd).returncode
 
     @classmethod
-    def _run_cmd(cls, cmd: str, show_command: bool = True):
-        if show_command:
-            print(f"\n{cmd}")
-        subprocess.run(cmd, shell=True)
+    def _run_cmds(
+        cls,
+        cmds: List[List[str]],
+        source: Optional[List[str]] = None,
+        outputs: Optional[List[str]] = None,
+        size_cap: Optional[int] = None,
+    ) -> List[Optional[int]]:
+        """
+        Run all commands at once and wait for every one to finish. If source
+        is given, each command reads its stdin from its own run of source.
+        With size_cap, a command is killed once its file in outputs grows
+        past size_cap bytes. Return each command's exit code, None if it was
+        killed for its size, or the source's exit code if only that failed
+        """
+        procs = list()
+        sources = list()
+        for cmd in cmds:
+            if source is None:
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug(shlex.join(cmd))
+                procs.append(subprocess.Popen(cmd))
+                continue
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug(f"{shlex.join(source)} | {shlex.join(cmd)}")
+            src = subprocess.Popen(source, stdout=subprocess.PIPE)
+            procs.append(subprocess.Popen(cmd, stdin=src.stdout))
+            # only the consumer holds the pipe so src stops if it exits early
+            src.stdout.close()
+            sources.append(src)
+        killed = set()
+        if size_cap is not None:
+            running = dict(zip(procs, outputs))
+            while running:
+                time.sleep(_SIZE_POLL)
+                for proc, out in list(running.items()):
+                    if proc.poll() is not None:
+                        del running[proc]
+                    elif os.path.getsize(out) > size_cap:
+                        proc.kill()
+                        killed.add(proc)
+                        del running[proc]
+        codes = list()
+        for i, proc in enumerate(procs):
+            code = proc.wait()
+            src_code = sources[i].wait() if sources else 0
+            if proc in killed:
+                codes.append(None)
+            else:
+                codes.append(code or src_code)
+        return codes
 
     @classmethod
-    def _ffprobe(cls, tar: str, stream_value: str) -> str:
-        """Return value of stream_value for target"""
-        formatted_str = (
-            f"ffprobe -v error -select_streams v:0 -show_entries "
-            f'stream={stream_value} -of default=nw=1:nk=1 "{tar}"'
-        )
+    def _ffprobe(
+        cls, tar: str, entries: str, quick: bool = False
+    ) -> Dict[str, str]:
+        """
+        Return a dict of the video stream's ffprobe entries to their values
+        for target. The container's duration is only used if the stream has
+        none. quick skips analysing frames, so values missing from the
+        headers are lost
+        """
+        cmd = [
+            "ffprobe", "-v", "error", *(_QUICK_PROBE if quick else []),
+            "-select_streams", "v:0", "-show_entries", entries,
+            "-of", "json", tar,
+        ]
         fout = subprocess.run(
-            formatted_str, stdout=subprocess.PIPE, shell=True
-        ).stdout.decode("utf-8")
-        return fout.strip()
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True
+        ).stdout
+        try:
+            probe = json.loads(fout)
+        except ValueError:
+            return dict()
+        streams = probe.get("streams") or [dict()]
+        values = {k: str(v) for k, v in streams[0].items()}
+        duration = probe.get("format", dict()).get("duration")
+        if values.get("duration", "N/A") == "N/A" and duration is not None:
+            values["duration"] = str(duration)
+        return values
 
 
 class GifskiEncoder(Encoder):
@@ -180,50 +380,49 @@ class GifskiEncoder(Encoder):
 
     def encode(self) -> str:
         """Encode video using gifski"""
-        if sys.platform == "win32":
-            gifski = "gifski.exe"
-        else:
-            gifski = "gifski"
-        GIFSKI_GIF = '{} {} --fps {} --width {} -o "{}"'
-
         einfo = self.einfo
-        owidth, _ = einfo.init_odims
-
-        einfo.oname = get_available_name(einfo.oname)
-
-        iname = os.path.basename(einfo.iname)
-        old_cwd = os.getcwd()
-        os.chdir(os.path.dirname(einfo.iname))
-
-        mul = 0.60
-        old_width = -1
-        while old_width != owidth:
-            formatted_str = GIFSKI_GIF.format(
-                gifski, iname, einfo.fps, owidth, einfo.oname
+        if gifski_reads_stdin():
+            # stream frames from ffmpeg instead of going through png files
+            self.frames = ["-"]
+            self.source = ffmpeg_cmds.video_to_y4m(
+                einfo.iname, einfo.fps, einfo.crop_rect
             )
+        else:
+            # expand the frame*.png pattern since there is no shell to do it
+            self.frames = sorted(glob.glob(einfo.iname))
+            self.source = None
+        return super().encode()
+
+    def _encode_widths(self, widths: List[int]) -> Dict[int, str]:
+        fps = self.einfo.fps
+        trials = dict()
+        cmds = list()
+        for owidth in widths:
+            trial = trials[owidth] = self._new_trial()
+            cmds.append(ffmpeg_cmds.gifski(self.frames, fps, owidth, trial))
+        # candidates are independent so run them side by side. gifski writes
+        # as it goes, so stop any that pass the size limit
+        codes = Encoder._run_cmds(
+            cmds, self.source, list(trials.values()), self.einfo.osize_limit
+        )
+        # None means it was stopped for going over the size limit
+        if any(code not in (0, None) for code in codes):
+            self._raise_failed("gifski", trials)
+        return trials
 
-            if show_commands:
-                print(f"\n{formatted_str}")
-
-            subprocess.run(formatted_str, shell=True)
-            size = os.stat(einfo.oname).st_size
-            print(f"size: {size//1024}KB")
-            size_is_within_range = (
-                einfo.osize_limit * einfo.osize_range
-                < size
-                < einfo.osize_limit
-            )
-            size_is_close_enough = not einfo.max_width_check(
-                owidth
-            ) and einfo.max_width_check(owidth + einfo.width_change_margin)
-
-            if size_is_within_range or (size_is_close_enough):
-                break
-            old_width = owidth
-            owidth, mul = self._wsize_and_mul(size, owidth, mul)
-
-        os.chdir(old_cwd)
-        return einfo.oname
+    def _finalize(self, width: int, trial: str):
+        """
+        Make the chosen trial the output. A trial over the size limit may have
+        been killed part way, so encode that width again in full instead
+        """
+        einfo = self.einfo
+        if os.path.getsize(trial) < einfo.osize_limit:
+            os.replace(trial, einfo.oname)
+            return
+        os.remove(trial)
+        cmd = ffmpeg_cmds.gifski(self.frames, einfo.fps, width, einfo.oname)
+        if Encoder._run_cmds([cmd], self.source) != [0]:
+            raise RuntimeError(f"gifski failed on {einfo.iname}")
 
 
 class FFmpegEncoder(Encoder):
@@ -232,49 +431,237 @@ class FFmpegEncoder(Encoder):
 
     def encode(self) -> str:
         """Encode video using ffmpeg"""
-        FFMPEG_GIF = (
-            'ffmpeg -y -i "{}" -filter_complex "[0:v] scale={}:{}'
-            ' [a];[a] split [b][c];[b] palettegen [p];[c][p] paletteuse" -loglevel warning "{}"'
-        )
-
-        FFMPEG_APNG = (
-            'ffmpeg -y -i "{}" -f apng -plays 0 -vf '
-            '"scale={}:{}:flags=lanczos,split[s0][s1];[s0]palettegen[p];[s1][p]paletteuse" '
-            '-loglevel warning "{}"'
-        )
-        ffmpeg_str = (
-            FFMPEG_APNG if self.einfo.oname.endswith(".png") else FFMPEG_GIF
-        )
         einfo = self.einfo
-        owidth, oheight = einfo.init_odims
-
-        einfo.oname = get_available_name(einfo.oname)
+        # a smaller palette is worth more than a smaller width once the width
+        # would drop below the size the output is shown at
+        wanted = min(einfo.init_odims[0], einfo.width_limit() - 1)
+        wanted -= einfo.width_change_margin
+        fd, self.palette = tempfile.mkstemp(suffix=".png")
+        os.close(fd)
+        # (rank, path, width) of the best output so far, set aside while
+        # retrying
+        best = None
+        try:
+            for attempt, colors in enumerate(einfo.palette_colors, start=1):
+                # the palette depends on the colours, not the scale. generate
+                # it once and only run paletteuse for each width
+                cmd = ffmpeg_cmds.palettegen(
+                    einfo.iname, self.palette, einfo.crop_rect, colors
+                )
+                if Encoder._run_cmd(cmd) != 0:
+                    raise RuntimeError(
+                        f"ffmpeg could not make a palette for {einfo.iname}"
+                    )
+                super().encode()
+                size = os.path.getsize(einfo.oname)
+                fits = size < einfo.osize_limit
+                # fitting beats not fitting, then wider or smaller is better
+                rank = (fits, self.owidth if fits else -size)
+                if best is None or rank > best[0]:
+                    if best is not None:
+                        os.remove(best[1])
+                    kept = self._new_trial()
+                    os.replace(einfo.oname, kept)
+                    best = (rank, kept, self.owidth)
+                else:
+                    os.remove(einfo.oname)
+                if self.owidth >= wanted:
+                    break
+                if attempt < len(einfo.palette_colors):
+                    log.info(
+                        "width %d at %d colors, retrying with fewer colors",
+                        self.owidth,
+                        colors,
+                    )
+            os.replace(best[1], einfo.oname)
+            self.owidth = best[2]
+            best = None
+            return einfo.oname
+        finally:
+            os.remove(self.palette)
+            if best is not None:
+                os.remove(best[1])
+
+    def _encode_widths(self, widths: List[int]) -> Dict[int, str]:
+        """
+        Encode every width from a single ffmpeg process so the source is only
+        decoded once. Trials only need a size, so use the faster scaler and
+        stop writing any that go over the size limit
+        """
+        trials = {owidth: self._new_trial() for owidth in widths}
+        if self._paletteuse(trials, "fast_bilinear", self.einfo.osize_limit):
+            self._raise_failed("ffmpeg", trials)
+        return trials
 
-        mul = 0.60
+    def _finalize(self, width: int, trial: str):
+        """
+        Encode the chosen width again with lanczos. Keep the trial if that
+        takes it over the size limit. A trial over the limit was cut short, so
+        it is never kept
+        """
+        einfo = self.einfo
+        encoded = self._paletteuse({width: einfo.oname}, "lanczos") == 0
+        limit = einfo.osize_limit
+        if encoded and (
+            os.path.getsize(einfo.oname) < limit
+            or os.path.getsize(trial) >= limit
+        ):
+            os.remove(trial)
+        elif os.path.getsize(trial) < limit:
+            os.replace(trial, einfo.oname)
+        else:
+            os.remove(trial)
+            raise RuntimeError(f"ffmpeg failed on {einfo.iname}")
 
-        old_width = -1
-        while old_width != owidth:
-            formatted_str = ffmpeg_str.format(
-                einfo.iname, owidth, oheight, einfo.oname
-            )
-            if show_commands:
-                print(f"\n{formatted_str}")
-
-            subprocess.run(formatted_str, shell=True)
-            size = os.stat(einfo.oname).st_size
-            print(f"size: {size//1024}KB")
-            if (
-                einfo.osize_limit * einfo.osize_range
-                < size
-                < einfo.osize_limit
-                or (
-                    not einfo.max_width_check(owidth)
-                    and einfo.max_width_check(owidth + 1)
-                )
-            ):
-                break
-            old_width = owidth
-            owidth, mul = self._wsize_and_mul(size, owidth, mul)
-            oheight = int(owidth * einfo.ohscale)
+    def _paletteuse(
+        self,
+        outputs: Dict[int, str],
+        flags: str,
+        size_cap: Optional[int] = None,
+    ) -> int:
+        """Scale to each width in outputs from one run. Return its exit code"""
+        einfo = self.einfo
+        cmd = ffmpeg_cmds.paletteuse(
+            einfo.iname,
+            self.palette,
+            [(w, int(w * einfo.ohscale), out) for w, out in outputs.items()],
+            einfo.oname.endswith(".png"),
+            flags,
+            einfo.crop_rect,
+            size_cap,
+        )
+        return Encoder._run_cmd(cmd)
+
+
+def _quick_probe_ok(values: Dict[str, str]) -> bool:
+    """Return False if a header-only probe missed any value we need"""
+    try:
+        # streams that weren't parsed yet report 0x0 at 0/0 fps
+        frames, seconds = values["r_frame_rate"].split("/")
+        if (
+            int(values["width"]) <= 0
+            or int(values["height"]) <= 0
+            or float(frames) <= 0
+            or float(seconds) <= 0
+            or values["codec_name"] in ("", "N/A")
+        ):
+            return False
+        # the sticker check needs a real duration, not N/A
+        float(values["duration"])
+    except (KeyError, ValueError):
+        return False
+    return True
+
+
+@lru_cache(maxsize=None)
+def gifski_reads_stdin() -> bool:
+    """Return True if the installed gifski can read a video from stdin"""
+    try:
+        out = subprocess.run(
+            ffmpeg_cmds.gifski_version(), capture_output=True, text=True
+        ).stdout
+    except OSError:
+        return False
+    match = _VERSION_RE.search(out)
+    if not match:
+        return False
+    version = tuple(int(n) for n in match.groups())
+    return version >= ffmpeg_cmds.GIFSKI_STDIN_VERSION
+
+
+def encode_job(einfo: EncodingInfo) -> Tuple[str, Optional[str]]:
+    """
+    Encode a single file. Runs in a worker process so it must stay a module
+    level function. Return the output name and the temp folder to remove, if
+    one was created
+    """
+    folder = None
+    if einfo.uses_gifski and not gifski_reads_stdin():
+        folder = Encoder.video_to_png(einfo)
+    return Encoder.new(einfo).encode(), folder
+
+
+class WidthSearch:
+    """
+    Bisect output widths between lo, the largest width known to fit within
+    the size limit, and hi, the smallest width known not to. The first
+    encode is a small seed whose size is used to estimate where to start,
+    and the next size corrects that estimate. Once the bounds are close, the
+    remaining candidates are tried together
+    """
+
+    SEED_WIDTH = 160
+    BRACKET_CANDIDATES = 3
+    # sizes used to estimate the width before falling back to bisecting
+    MAX_ESTIMATES = 2
 
-        return einfo.oname
+    def __init__(self, einfo: EncodingInfo):
+        self.einfo = einfo
+        self.lo = 0
+        # every width from here up is out of bounds so never gets proposed
+        self.hi = einfo.width_limit()
+        self.estimate: Optional[int] = None
+        # (width, size) of every encode so far
+        self.samples: List[Tuple[int, int]] = list()
+        self.seeded = False
+        # whether any width has actually been encoded
+        self.encoded = False
+
+    def update(self, width: int, fits: bool, size: Optional[int] = None):
+        """Narrow the bounds using the result at width"""
+        if fits:
+            self.lo = max(self.lo, width)
+        else:
+            self.hi = min(self.hi, width)
+        if size is not None:
+            self.encoded = True
+        # sizes over the limit may be from trials that were cut short
+        if size and fits:
+            self.samples.append((width, size))
+            if len(self.samples) <= self.MAX_ESTIMATES:
+                self.estimate = self._estimate()
+        self.seeded = True
+
+    def next_widths(self) -> List[int]:
+        """
+        Return the widths to try next or an empty list once the bounds are
+        within the width change margin
+        """
+        if not self.seeded:
+            return [min(self.einfo.init_odims[0], self.SEED_WIDTH)]
+        margin = self.einfo.width_change_margin
+        if self.hi - self.lo <= margin:
+            # narrow sources can start this close. still make an output
+            if not self.encoded and self.hi > 1:
+                return [self.hi - 1]
+            return []
+        if self.estimate is not None:
+            estimate, self.estimate = self.estimate, None
+            if self.lo < estimate < self.hi:
+                return [estimate]
+        n = self.BRACKET_CANDIDATES
+        if self.hi - self.lo > (n + 1) * margin:
+            return [(self.lo + self.hi) // 2]
+        step = (self.hi - self.lo) / (n + 1)
+        widths = {self.lo + round(step * i) for i in range(1, n + 1)}
+        return sorted(w for w in widths if self.lo < w < self.hi)
+
+    def _estimate(self) -> int:
+        """
+        Estimate the width that lands in the middle of the accepted size range
+        assuming size grows with the pixel count, i.e. width squared. With two
+        sizes, use the growth rate measured between them instead
+        """
+        einfo = self.einfo
+        target = einfo.osize_limit * (1 + einfo.osize_range) / 2
+        width, size = self.samples[-1]
+        power = 2.0
+        if len(self.samples) > 1:
+            w0, s0 = self.samples[-2]
+            if w0 != width and s0 != size:
+                measured = math.log(size / s0) / math.log(width / w0)
+                # palette and frame overhead can make a pair of sizes noisy
+                if 0.5 <= measured <= 4:
+                    power = measured
+        estimate = int(width * (target / size) ** (1 / power))
+        return min(max(estimate, self.lo + 1), self.hi - 1)
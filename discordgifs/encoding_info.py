@@ -1,28 +1,126 @@
-import shutil
-from abc import ABC, abstractmethod
+import math
 from dataclasses import dataclass
-from typing import Tuple
+from fractions import Fraction
+from typing import Optional, Tuple
 
 from consts import BANNER_RATIO, InitialFrameSize, OutputSize
-from utils import get_available_name
+from utils import get_available_name, which_cached
+
+_GIFSKI_AVAILABLE = which_cached(["gifski"])["gifski"] is not None
 
 OUTPUT_CHOICES = ["emote", "pfp", "server icon", "banner", "sticker"]
 
 
-@dataclass
-class EncodingInfo(ABC):
+@dataclass(frozen=True)
+class OutputSpec:
+    """Fixed encoding settings for an output choice"""
+
+    init_odims: Tuple[int, int]
+    osize_limit: int
+    osize_range: float
+    oscale: Tuple[Fraction, Fraction]
+    ext: str
+    gifski_capable: bool
+    width_change_margin: int
+    # palette sizes to try in turn while the width falls short of init_odims
+    palette_colors: Tuple[int, ...] = (256,)
+
+
+_OUT_SPEC = {
+    "emote": OutputSpec(
+        init_odims=InitialFrameSize.EMOTE,
+        osize_limit=OutputSize.EMOTE,
+        osize_range=0.95,
+        oscale=(1, 1),
+        ext=".gif",
+        gifski_capable=False,
+        width_change_margin=1,
+        palette_colors=(256, 128, 64),
+    ),
+    "pfp": OutputSpec(
+        init_odims=InitialFrameSize.PFP,
+        osize_limit=OutputSize.PFP,
+        osize_range=0.85,
+        oscale=(1, 1),
+        ext=".gif",
+        gifski_capable=True,
+        width_change_margin=20,
+    ),
+    "server icon": OutputSpec(
+        init_odims=InitialFrameSize.PFP,
+        osize_limit=OutputSize.SERVER_ICON,
+        osize_range=0.85,
+        oscale=(1, 1),
+        ext=".gif",
+        gifski_capable=True,
+        width_change_margin=20,
+    ),
+    "banner": OutputSpec(
+        init_odims=InitialFrameSize.BANNER,
+        osize_limit=OutputSize.BANNER,
+        osize_range=0.85,
+        oscale=BANNER_RATIO,
+        ext=".gif",
+        gifski_capable=True,
+        width_change_margin=20,
+    ),
+    "sticker": OutputSpec(
+        init_odims=InitialFrameSize.STICKER,
+        osize_limit=OutputSize.STICKER,
+        osize_range=0.95,
+        oscale=(1, 1),
+        ext=".png",
+        gifski_capable=False,
+        width_change_margin=20,
+    ),
+}
+
+
+class EncodingInfo:
+    __slots__ = (
+        "iname",
+        "iwidth",
+        "iheight",
+        "icodec",
+        "oname",
+        "owscale",
+        "ohscale",
+        "osize_limit",
+        "osize_range",
+        "fps",
+        "out_choice",
+        "uses_gifski",
+        "init_odims",
+        "width_change_margin",
+        "iratio",
+        "oratio",
+        "crop",
+        "auto_crop",
+        "crop_rect",
+        "palette_colors",
+    )
+
     iname: str
     iwidth: int
     iheight: int
     icodec: str
     oname: str
-    owscale: float
-    ohscale: float
+    owscale: Fraction
+    ohscale: Fraction
     osize_limit: int
     osize_range: float
     fps: int
     out_choice: str
     uses_gifski: bool
+    init_odims: Tuple[int, int]
+    width_change_margin: int
+    iratio: Fraction
+    oratio: Fraction
+    crop: bool
+    auto_crop: bool
+    # w, h, x, y applied to the input while encoding
+    crop_rect: Optional[Tuple[int, int, int, int]]
+    palette_colors: Tuple[int, ...]
 
     def __init__(
         self,
@@ -37,10 +135,26 @@ class EncodingInfo(ABC):
 
         self.iwidth = iwidth
         self.iheight = iheight
+        self.iratio = Fraction(iheight, iwidth)
         self.icodec = icodec
         self.fps = fps
         self.out_choice = out_choice
 
+        spec = _OUT_SPEC[out_choice]
+        self.init_odims = spec.init_odims
+        self.osize_limit = spec.osize_limit
+        self.osize_range = spec.osize_range
+        # exact ratios so crops land on the output ratio without rounding
+        self.owscale, self.ohscale = map(Fraction, spec.oscale)
+        self.oratio = self.ohscale / self.owscale
+        self.width_change_margin = spec.width_change_margin
+        self.palette_colors = spec.palette_colors
+        self.oname = get_available_name(iname, ext=spec.ext)
+        self.uses_gifski = spec.gifski_capable and _GIFSKI_AVAILABLE
+        self.crop = False
+        self.auto_crop = False
+        self.crop_rect = None
+
     @classmethod
     def new(
         cls,
@@ -52,110 +166,36 @@ class EncodingInfo(ABC):
         fps: int,
     ):
         out_choice = out_choice.lower().strip()
-        if out_choice not in OUTPUT_CHOICES:
+        if out_choice not in _OUT_SPEC:
             raise ValueError(f"Invalid output choice: {out_choice}")
-        if out_choice == "banner":
-            return BannerEncodingInfo(iname, iwidth, iheight, icodec, fps)
-        elif out_choice == "emote":
-            return EmoteEncodingInfo(iname, iwidth, iheight, icodec, fps)
-        elif out_choice == "sticker":
-            return StickerEncodingInfo(iname, iwidth, iheight, icodec, fps)
-        else:
-            return PfpEncodingInfo(iname, iwidth, iheight, icodec, fps)
+        return cls(iname, iwidth, iheight, icodec, out_choice, fps)
 
-    @property
-    def iratio(self) -> float:
-        return self.iheight / self.iwidth
-
-    @property
-    def oratio(self) -> float:
-        return self.ohscale / self.owscale
-
-    @property
-    @abstractmethod
-    def init_odims(self) -> Tuple[int, int]:
-        raise NotImplementedError("init_odims must be implemented")
+    def set_dimensions(self, iwidth: int, iheight: int):
+        """Update the input dimensions, e.g. after cropping"""
+        self.iwidth = iwidth
+        self.iheight = iheight
+        self.iratio = Fraction(iheight, iwidth)
 
     @property
     def is_sticker(self) -> bool:
         return self.out_choice == "sticker"
 
-    @property
-    def width_change_margin(self) -> int:
-        return 1 if self.osize_limit == OutputSize.EMOTE else 20
-
-    def max_width_check(self, width: int) -> bool:
+    def crop_size(self) -> Tuple[int, int]:
         """
-        Return True if given width will take video out of bounds based on the
-        input and output widths and heights
+        Return the width and height of the largest area of the input that
+        matches the output's aspect ratio
         """
-        output_height = (width * self.ohscale) * self.oratio
-        return width >= self.iwidth or (output_height > self.iheight)
+        if self.iratio > self.oratio:
+            return self.iwidth, int(self.iwidth * self.ohscale)
+        return int(self.iheight * (self.owscale / self.ohscale)), self.iheight
 
+    def width_limit(self) -> int:
+        """
+        Return the smallest width that takes the video out of bounds based on
+        the input and output widths and heights
+        """
+        return min(self.iwidth, math.floor(self.iheight / self.oratio) + 1)
 
-class BannerEncodingInfo(EncodingInfo):
-    def __init__(
-        self, iname: str, iwidth: int, iheight: int, icodec: str, fps: int
-    ):
-        super().__init__(iname, iwidth, iheight, icodec, "banner", fps)
-        self.owscale, self.ohscale = BANNER_RATIO
-        self.osize_limit = OutputSize.BANNER
-        self.osize_range = 0.85
-        self.oname = get_available_name(iname, ext=".gif")
-        self.uses_gifski = shutil.which("gifski") is not None
-
-    @property
-    def init_odims(self) -> Tuple[int, int]:
-        """Return the initial output dimensions based on the out_choice"""
-        return InitialFrameSize.BANNER
-
-
-class EmoteEncodingInfo(EncodingInfo):
-    def __init__(
-        self, iname: str, iwidth: int, iheight: int, icodec: str, fps: int
-    ):
-        super().__init__(iname, iwidth, iheight, icodec, "emote", fps)
-        self.owscale, self.ohscale = 1, 1
-        self.osize_limit = OutputSize.EMOTE
-        self.osize_range = 0.95
-        self.oname = get_available_name(iname, ext=".gif")
-        self.uses_gifski = False
-
-    @property
-    def init_odims(self) -> Tuple[int, int]:
-        """Return the initial output dimensions based on the out_choice"""
-        return InitialFrameSize.EMOTE
-
-
-class PfpEncodingInfo(EncodingInfo):
-    def __init__(
-        self, iname: str, iwidth: int, iheight: int, icodec: str, fps: int
-    ):
-        super().__init__(iname, iwidth, iheight, icodec, "pfp", fps)
-        self.owscale, self.ohscale = 1, 1
-        self.osize_limit = OutputSize.PFP
-        self.osize_range = 0.85
-        self.oname = get_available_name(iname, ext=".gif")
-        self.uses_gifski = shutil.which("gifski") is not None
-
-    @property
-    def init_odims(self) -> Tuple[int, int]:
-        """Return the initial output dimensions based on the out_choice"""
-        return InitialFrameSize.PFP
-
-
-class StickerEncodingInfo(EncodingInfo):
-    def __init__(
-        self, iname: str, iwidth: int, iheight: int, icodec: str, fps: int
-    ):
-        super().__init__(iname, iwidth, iheight, icodec, "sticker", fps)
-        self.owscale, self.ohscale = 1, 1
-        self.osize_limit = OutputSize.STICKER
-        self.osize_range = 0.95
-        self.oname = get_available_name(iname, ext=".png")
-        self.uses_gifski = False
-
-    @property
-    def init_odims(self) -> Tuple[int, int]:
-        """Return the initial output dimensions based on the out_choice"""
-        return InitialFrameSize.STICKER
+    def max_width_check(self, width: int) -> bool:
+        """Return True if given width will take video out of bounds"""
+        return width >= self.width_limit()
@@ -1,33 +1,157 @@
 import os
-import re
-from typing import Tuple
+import sys
+from string import digits
+from typing import List, Optional, Tuple
 
 from utils import get_available_name
 
+# threads each ffmpeg may use. lowered when several encodes run at once
+_threads = str(os.cpu_count() or 1)
+# no banner, progress lines or overwrite prompts from any ffmpeg run
+_FFMPEG = ["ffmpeg", "-y", "-hide_banner", "-nostats"]
+_GIFSKI_BIN = "gifski.exe" if sys.platform == "win32" else "gifski"
+# intermediates only get read back by ffmpeg, so favour encode speed over size
+_LOSSLESS = ["-c:v", "ffv1", "-level", "3"]
+# first gifski release that can read video from stdin
+GIFSKI_STDIN_VERSION = (1, 11)
+
+
+def set_threads(threads: int):
+    """Limit the threads used by every ffmpeg command built after this"""
+    global _threads
+    _threads = str(max(1, threads))
+
+
+def _crop_filter(crop: Optional[Tuple[int, int, int, int]]) -> str:
+    """Return a crop filter to put in front of a filter chain, if any"""
+    if crop is None:
+        return ""
+    w, h, x, y = crop
+    return f"crop={w}:{h}:{x}:{y},"
+
 
 def png_to_video(
     filename: str, dirname: str, output_fps: int, out: str
-) -> str:
-    PNG_TO_VIDEO = (
-        'ffmpeg -y -r {} -i "{}" -c:v libx264 -crf 0 -vf fps={} '
-        '-pix_fmt yuv420p -loglevel warning "{}"'
-    )
-    num_of_digits = len(re.findall(r"\d+", filename)[0])
-    seq_input = re.sub(r"\d+", f"%0{num_of_digits}d", filename)
-    seq_input = os.path.join(dirname, seq_input)
-    return PNG_TO_VIDEO.format(output_fps, seq_input, output_fps, out)
-
-
-def video_to_png(iname: str, fps: int, dir_: str) -> str:
-    PNG = r'ffmpeg -i "{}" -vf fps={} -loglevel warning "{}/frame%05d.png"'
-    return PNG.format(iname, fps, dir_)
-
-
-def crop(inp: str, w: int, h: int, x: int, y: int) -> Tuple[str, str]:
-    """Return crop string and output file name."""
-    CROP = 'ffmpeg -y -i "{}" -filter:v "crop={}:{}:{}:{}" -c:v libx264 -crf 0 -an -loglevel warning "{}"'
-    out = get_available_name(inp, "mp4")
-    return CROP.format(inp, w, h, x, y, out), out
-
-def ffplay_preview(video: str) -> str:
-    return f'ffplay -autoexit -loop 0 -an -loglevel warning "{video}"'
+) -> List[str]:
+    stem, ext = os.path.splitext(filename)
+    prefix = stem.rstrip(digits)
+    num_of_digits = len(stem) - len(prefix)
+    seq_input = os.path.join(dirname, f"{prefix}%0{num_of_digits}d{ext}")
+    return [
+        *_FFMPEG, "-filter_threads", _threads,
+        "-r", str(output_fps), "-i", seq_input,
+        *_LOSSLESS, "-threads", _threads, "-vf", f"fps={output_fps}",
+        "-pix_fmt", "yuv420p", "-loglevel", "warning", out,
+    ]
+
+
+def video_to_png(
+    iname: str,
+    fps: int,
+    dir_: str,
+    crop: Optional[Tuple[int, int, int, int]] = None,
+) -> List[str]:
+    vf = f"{_crop_filter(crop)}fps={fps}"
+    return [
+        *_FFMPEG, "-filter_threads", _threads,
+        "-i", iname, "-vf", vf, "-compression_level", "1",
+        "-threads", _threads, "-loglevel", "warning",
+        os.path.join(dir_, "frame%05d.png"),
+    ]
+
+
+def video_to_y4m(
+    iname: str, fps: int, crop: Optional[Tuple[int, int, int, int]] = None
+) -> List[str]:
+    """Return a command that streams the video to stdout for gifski"""
+    vf = f"{_crop_filter(crop)}fps={fps}"
+    return [
+        *_FFMPEG, "-filter_threads", _threads,
+        "-i", iname, "-vf", vf, "-f", "yuv4mpegpipe",
+        "-loglevel", "warning", "-",
+    ]
+
+
+def crop(inp: str, w: int, h: int, x: int, y: int) -> Tuple[List[str], str]:
+    """Return crop command and output file name."""
+    out = get_available_name(inp, "mkv")
+    cmd = [
+        *_FFMPEG, "-filter_threads", _threads,
+        "-i", inp, "-filter:v", f"crop={w}:{h}:{x}:{y}",
+        *_LOSSLESS, "-threads", _threads, "-an", "-loglevel", "warning",
+        out,
+    ]
+    return cmd, out
+
+
+def palettegen(
+    iname: str,
+    palette: str,
+    crop: Optional[Tuple[int, int, int, int]] = None,
+    max_colors: int = 256,
+) -> List[str]:
+    vf = f"{_crop_filter(crop)}palettegen=max_colors={max_colors}"
+    vf += ":stats_mode=diff"
+    return [
+        *_FFMPEG, "-filter_threads", _threads,
+        "-i", iname, "-vf", vf,
+        "-threads", _threads, "-loglevel", "warning", palette,
+    ]
+
+
+def paletteuse(
+    iname: str,
+    palette: str,
+    outputs: List[Tuple[int, int, str]],
+    apng: bool,
+    flags: str = "lanczos",
+    crop: Optional[Tuple[int, int, int, int]] = None,
+    size_cap: Optional[int] = None,
+) -> List[str]:
+    """
+    Return a command that scales iname to each (width, height, out) in outputs
+    from a single decode of the input. flags picks the scaling algorithm.
+    Outputs stop being written once they go past size_cap bytes
+    """
+    n = len(outputs)
+    split = f"{_crop_filter(crop)}split={n}"
+    graph = [
+        f"[0:v] {split} " + "".join(f"[s{i}]" for i in range(n)),
+        f"[1:v] split={n} " + "".join(f"[p{i}]" for i in range(n)),
+    ]
+    out_args = list()
+    for i, (w, h, out) in enumerate(outputs):
+        graph.append(
+            f"[s{i}] scale={w}:{h}:flags={flags} [a{i}];"
+            f"[a{i}][p{i}] paletteuse=dither=bayer [o{i}]"
+        )
+        out_args += ["-map", f"[o{i}]"]
+        if apng:
+            out_args += ["-f", "apng", "-plays", "0"]
+        if size_cap is not None:
+            out_args += ["-fs", str(size_cap)]
+        out_args += ["-threads", _threads, out]
+    return [
+        *_FFMPEG, "-filter_complex_threads", _threads,
+        "-i", iname, "-i", palette,
+        "-filter_complex", ";".join(graph), "-loglevel", "warning", *out_args,
+    ]
+
+
+def gifski(frames: List[str], fps: int, width: int, out: str) -> List[str]:
+    """Pass ["-"] as frames to read a yuv4mpeg stream from stdin"""
+    return [
+        _GIFSKI_BIN, *frames, "--fps", str(fps), "--width", str(width),
+        "--quiet", "-o", out,
+    ]
+
+
+def gifski_version() -> List[str]:
+    return [_GIFSKI_BIN, "--version"]
+
+
+def ffplay_preview(video: str) -> List[str]:
+    return [
+        "ffplay", "-autoexit", "-loop", "0", "-an", "-loglevel", "warning",
+        video,
+    ]
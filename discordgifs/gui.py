@@ -1,12 +1,25 @@
+import logging
 import os
 import re
-import shutil
+import time
+from collections import deque
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+)
 from dataclasses import dataclass
+from itertools import chain
 from pathlib import Path
+from typing import List, Optional, Tuple
 
 import dearpygui.dearpygui as dpg
-from encoder import Encoder
+import ffmpeg_cmds
+from encoder import Encoder, encode_job
 from encoding_info import OUTPUT_CHOICES, EncodingInfo
+from utils import format_size, get_file_sizes, remove_path, which_cached
+
+_PNG_SEQ_RE = re.compile(r"(\d{1,5})\.png$", re.IGNORECASE)
 
 
 @dataclass(frozen=True)
@@ -35,99 +48,112 @@ class Tags:
 
 
 class GuiHandler:
-    VALID_EXTS = (
-        ".gif",
-        ".png",
-        ".mp4",
-        ".webm",
-        ".mkv",
-        ".avi",
-        ".mov",
-        ".wmv",
-        ".flv",
-        ".mpg",
-        ".mpeg",
-        ".m4v",
-        ".ts",
+    VALID_EXTS = frozenset(
+        {
+            ".gif",
+            ".png",
+            ".mp4",
+            ".webm",
+            ".mkv",
+            ".avi",
+            ".mov",
+            ".wmv",
+            ".flv",
+            ".mpg",
+            ".mpeg",
+            ".m4v",
+            ".ts",
+        }
     )
     DEBUG = False
     STYLE = False
+    # Files encoded in parallel
+    MAX_JOBS = os.cpu_count() or 1
+    # Seconds the filename must stay unchanged before it is probed
+    FILENAME_DEBOUNCE = 0.25
+    # Only the most recent messages are kept
+    MAX_MESSAGES = 200
 
     def __init__(self):
         self.dependency_message = None
         self.title = "DiscordGifs"
-        self.messages = list()
+        # text items in the messages pane, newest first
+        self.messages = deque()
 
         self.files_to_process = list()
-        self.to_crop = list()
+        self.to_crop = deque()
         self.temp_files = list()
         self.cropped_filenames = list()
         self.output_files = list()
 
         self.current_file = None
+        self.crop_rect = None
+        self.pending_filename = None
+        # (future, sender, path, user_data) of the probe being waited on
+        self.probe_job = None
+        # one worker so probes finish in the order the filenames were typed
+        self.probe_pool = ThreadPoolExecutor(max_workers=1)
 
     def reset_values(self):
         self.files_to_process = list()
-        self.to_crop = list()
+        self.to_crop = deque()
         self.temp_files = list()
         self.cropped_filenames = list()
         self.output_files = list()
         self.current_file = None
+        self.crop_rect = None
 
     #########
     # Helpers
     #########
 
+    def has_valid_ext(self, path):
+        return os.path.splitext(path)[1].lower() in self.VALID_EXTS
+
     def is_valid_file(self, path):
-        return path.endswith(self.VALID_EXTS) and os.path.isfile(path)
+        return self.has_valid_ext(path) and os.path.isfile(path)
 
     def show_message(self, msg: str):
-        self.messages.insert(0, msg)
-        dpg.set_value(Tags.messages, "\n".join(self.messages))
+        # add one line at the top instead of replacing the whole pane
+        newest = self.messages[0] if self.messages else 0
+        item = dpg.add_text(msg, parent=Tags.messages, before=newest)
+        self.messages.appendleft(item)
+        if len(self.messages) > self.MAX_MESSAGES:
+            dpg.delete_item(self.messages.pop())
+        dpg.set_y_scroll(Tags.messages, 0)
 
     def clean_up(self):
-        """Delete temp files"""
-        for f in self.temp_files + self.cropped_filenames:
-            try:
-                if os.path.isfile(f):
-                    os.remove(f)
-                else:
-                    shutil.rmtree(f)
-            except (FileNotFoundError, OSError, PermissionError) as e:
+        """Delete temp files. Removals are IO bound so run them in parallel"""
+        paths = list(chain(self.temp_files, self.cropped_filenames))
+        with ThreadPoolExecutor() as executor:
+            errors = list(executor.map(remove_path, paths))
+        for f, e in zip(paths, errors):
+            if e is not None:
                 self.show_message(f"Error removing {f}: {e}")
 
     def show_crop_modal(self, hide_x: bool):
-        dpg.configure_item(Tags.crop_x_slider, show=True)
-        dpg.configure_item(Tags.crop_y_slider, show=True)
-
-        if hide_x:
-            dpg.configure_item(Tags.crop_x_slider, show=False)
-            cood = "y"
-        else:
-            dpg.configure_item(Tags.crop_y_slider, show=False)
-            cood = "x"
         einfo = self.current_file
+        # one call per slider sets both its visibility and range
+        dpg.configure_item(
+            Tags.crop_x_slider, show=not hide_x, max_value=einfo.iwidth
+        )
+        dpg.configure_item(
+            Tags.crop_y_slider, show=hide_x, max_value=einfo.iheight
+        )
+        cood = "y" if hide_x else "x"
         dpg.configure_item(Tags.crop_window, show=True)
         dpg.set_value(
             Tags.crop_message,
             f"Set {cood} value for cropping. Preview. Confirm or readjust value",
         )
-        dpg.configure_item(Tags.crop_x_slider, max_value=einfo.iwidth)
-        dpg.configure_item(Tags.crop_y_slider, max_value=einfo.iheight)
 
     def auto_crop_file(self, einfo: EncodingInfo):
-        if einfo.iratio > einfo.oratio:
-            w = einfo.iwidth
-            h = int(einfo.iwidth * einfo.ohscale)
-        else:
-            h = einfo.iheight
-            w = int(einfo.iheight * (einfo.owscale / einfo.ohscale))
-        y = int((einfo.iheight - h) / 2)
-        x = int((einfo.iwidth - w) / 2)
-        cropped_filename = Encoder.crop(einfo.iname, w, h, x, y)
-        self.cropped_filenames.append(cropped_filename)
-        einfo.iname = cropped_filename
-        einfo.iwidth, einfo.iheight = Encoder.get_dimensions(cropped_filename)
+        w, h = einfo.crop_size()
+        y = (einfo.iheight - h) // 2
+        x = (einfo.iwidth - w) // 2
+        # crop while encoding rather than writing a cropped copy first
+        einfo.crop_rect = (w, h, x, y)
+        einfo.set_dimensions(w, h)
         self.current_file = None
 
     ###########
@@ -138,50 +164,119 @@ class GuiHandler:
 
     def filename_callback(self, sender, path, user_data):
         """
+        Wait for typing to settle before probing the file. Clearing the input
+        is handled straight away
+
         Expected keys in user_data
         "default_prompt" - Default text attached to the fps input
         "default_fps" - Default fps when input file has no fps value
         """
-        path = path.strip('"')
-        valid_file = self.is_valid_file(path)
+        if path.strip('"').strip() == "":
+            self.pending_filename = None
+            # a probe still running for the old path must not overwrite this
+            self.probe_job = None
+            self.show_filename_check(sender, user_data, ("", None, False))
+            return
+        due = time.monotonic() + self.FILENAME_DEBOUNCE
+        self.pending_filename = (sender, path, user_data, due)
 
-        png_codec = ""
-        if not valid_file:
-            if path.strip() != "":
-                label = (
-                    f"Invalid file type: {os.path.splitext(path)[1]}"
-                    if os.path.isfile(path)
-                    else "File not found"
-                )
-                dpg.configure_item(sender, label=label)
-            else:
-                dpg.configure_item(sender, label="")
-            dpg.set_value(Tags.fps_text, user_data["default_prompt"])
-            dpg.set_value(Tags.fps_input, user_data["default_fps"])
+    def check_pending_filename(self):
+        """
+        Called every frame. Probe the filename once it has settled and show
+        the result once the probe is done. The probe runs on a worker thread
+        so ffprobe never stalls rendering
+        """
+        if self.probe_job is not None and self.probe_job[0].done():
+            future, sender, path, user_data = self.probe_job
+            self.probe_job = None
+            # the input may have changed while the probe ran
+            if dpg.get_value(sender) == path:
+                self.show_filename_check(sender, user_data, future.result())
+        if self.pending_filename is None:
+            return
+        sender, path, user_data, due = self.pending_filename
+        if time.monotonic() >= due:
+            self.pending_filename = None
+            future = self.probe_pool.submit(self.check_filename, path)
+            self.probe_job = (future, sender, path, user_data)
+
+    def flush_filename_check(self):
+        """
+        Check the filename now if its probe is still waiting or running, so
+        the fps shown is for the current file
+        """
+        if self.pending_filename is not None:
+            sender, _, user_data, _ = self.pending_filename
+        elif self.probe_job is not None:
+            _, sender, _, user_data = self.probe_job
+        else:
             return
+        self.pending_filename = None
+        self.probe_job = None
+        check = self.check_filename(dpg.get_value(sender))
+        self.show_filename_check(sender, user_data, check)
 
-        # if valid file update label
-        if path.endswith(".gif"):
+    def check_filename(self, path: str) -> Tuple[str, Optional[float], bool]:
+        """
+        Return the label for path, its fps if it should be shown and whether
+        the file can be used. Runs on the probe thread so it must not touch
+        the gui
+        """
+        path = path.strip('"')
+
+        # cheapest checks first. at most one stat per call
+        if path.strip() == "":
+            return "", None, False
+        if not os.path.isfile(path):
+            return "File not found", None, False
+        if not self.has_valid_ext(path):
+            ext = os.path.splitext(path)[1]
+            return f"Invalid file type: {ext}", None, False
+
+        # one probe covers the codec and fps
+        probe = Encoder.probe_all(path)
+        if "codec_name" not in probe:
+            return "Could not read file", None, False
+        png_codec = ""
+        ext = os.path.splitext(path)[1].lower()
+        if ext == ".gif":
             label = "Gif found"
-        elif path.endswith(".png"):
-            png_codec = Encoder.get_codec(path)
+        elif ext == ".png":
+            png_codec = probe["codec_name"]
             label = "apng found" if png_codec == "apng" else "png found"
         else:
             label = "Video found"
-        dpg.configure_item(sender, label=label)
 
         # display source fps unless it's an image sequence
         if png_codec == "png":
+            return label, None, True
+        try:
+            fps = Encoder.parse_fps(probe["r_frame_rate"])
+        except (KeyError, ValueError, ZeroDivisionError):
+            fps = None
+        return label, fps, True
+
+    def show_filename_check(
+        self,
+        sender,
+        user_data,
+        check: Tuple[str, Optional[float], bool],
+    ):
+        label, fps, valid = check
+        dpg.configure_item(sender, label=label)
+        if fps is None:
             dpg.set_value(Tags.fps_text, user_data["default_prompt"])
+            if not valid:
+                dpg.set_value(Tags.fps_input, user_data["default_fps"])
             return
-
-        fps = Encoder.get_fps(path)
         dpg.set_value(
             Tags.fps_text, f"{user_data['default_prompt']}, Source is {fps}fps"
         )
         dpg.set_value(Tags.fps_input, round(fps))
 
     def add_file_callback(self):
+        # the fps input must be set for this file before it's read below
+        self.flush_filename_check()
         filename = dpg.get_value(Tags.filename_input).strip('"')
         print(f"{filename=}")
         print(f"{Tags.filename_input=}")
@@ -196,7 +291,7 @@ class GuiHandler:
         )
 
         # png to video
-        numpng = re.search(r"[^\d]*(\d{1,5}).png", einfo.iname)
+        numpng = _PNG_SEQ_RE.search(einfo.iname)
         if einfo.icodec == "png" and numpng:
             self.show_message("Converting png sequence to video")
             tmp = Encoder.png_to_video(einfo.iname, einfo.fps)
@@ -217,6 +312,8 @@ class GuiHandler:
         einfo.crop = dpg.get_value(Tags.crop_checkbox)
         einfo.auto_crop = dpg.get_value(Tags.auto_crop_checkbox)
         self.files_to_process.append(einfo)
+        if einfo.crop and einfo.iratio != einfo.oratio:
+            self.to_crop.append(einfo)
         self.show_message(f"Added {einfo.iname} to queue")
 
         assert (
@@ -233,64 +330,83 @@ class GuiHandler:
     def encode_callback(self):
         dpg.configure_item(Tags.encode_button, enabled=False)
         dpg.configure_item(Tags.queue_button, enabled=False)
-        self.to_crop = [
-            ei
-            for ei in self.files_to_process
-            if ei.iratio != ei.oratio and ei.crop
-        ]
+        self.process_crops()
+
+    def process_crops(self):
+        """
+        Crop the files that need it, then encode everything. A manual crop
+        stops here until its confirm callback picks up where this left off
+        """
         while self.to_crop:
             self.show_message("Cropping files")
-            self.current_file = self.to_crop.pop(0)
-            if self.current_file.auto_crop:
-                self.auto_crop_file(self.current_file)
-                self.encode_callback()
-            else:
+            self.current_file = self.to_crop.popleft()
+            if not self.current_file.auto_crop:
                 self.show_crop_modal(
                     hide_x=self.current_file.iratio > self.current_file.oratio
                 )
-            return
+                return
+            self.auto_crop_file(self.current_file)
+        self.process_encodes()
 
+    def process_encodes(self):
         self.output_files = list()
 
-        while self.files_to_process:
-            einfo = self.files_to_process.pop(0)
-            self.current_file = einfo
-            encoder_ = Encoder.new(einfo)
-
+        jobs = self.files_to_process
+        self.files_to_process = list()
+        Encoder.assign_output_names(jobs)
+        for einfo in jobs:
+            self.show_message(f"Encoding {einfo.iname}")
+        dpg.configure_item(
+            Tags.encode_button, label=f"Encoding ({len(jobs)} in queue)"
+        )
+        try:
+            self.run_encodes(jobs)
+        finally:
+            # a crashed pool must not leave the ui stuck
             dpg.configure_item(
                 Tags.encode_button,
-                label=f"Encoding ({len(self.files_to_process)} more in queue)",
+                label=f"Encode ({len(self.files_to_process)} queued)",
             )
+            self.clean_up()
+            self.reset_values()
+            dpg.configure_item(Tags.encode_button, enabled=True)
+            dpg.configure_item(Tags.queue_button, enabled=True)
 
-            if einfo.uses_gifski:
-                self.show_message(
-                    f"Creating image sequence from {os.path.basename(einfo.iname)} for gifski"
+    def run_encodes(self, jobs: List[EncodingInfo]):
+        """Encode jobs in parallel and report each one as it finishes"""
+        workers = max(1, min(len(jobs), self.MAX_JOBS))
+        # split the cores between the encodes so they don't oversubscribe
+        threads = (os.cpu_count() or 1) // workers
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=init_encode_worker,
+            initargs=(threads,),
+        ) as executor:
+            futures = {
+                executor.submit(encode_job, einfo): einfo for einfo in jobs
+            }
+            for done, future in enumerate(as_completed(futures), start=1):
+                try:
+                    out, tmp = future.result()
+                except Exception as e:
+                    iname = futures[future].iname
+                    self.show_message(f"Failed to encode {iname}: {e}")
+                else:
+                    self.output_files.append(out)
+                    if tmp:
+                        self.temp_files.append(tmp)
+                dpg.configure_item(
+                    Tags.encode_button,
+                    label=f"Encoding ({len(jobs) - done} in queue)",
                 )
-                tmp = Encoder.video_to_png(einfo)
-                self.temp_files.append(tmp)
-            self.show_message(f"Encoding {einfo.iname}")
-
-            self.output_files.append(encoder_.encode())
-            self.current_file = None
-
-        assert len(self.files_to_process) == 0, "files_to_process not cleared"
-        dpg.configure_item(
-            Tags.encode_button,
-            label=f"Encode ({len(self.files_to_process)} queued)",
-        )
 
+        sizes = get_file_sizes(self.output_files)
         for out in self.output_files:
-            size = os.stat(out).st_size
-            size_str = (
-                f"{size / 1_000:.2f}KB"
-                if size < 1_000_000
-                else f"{size / 1_000_000:.2f}MB"
-            )
-            self.show_message(f"Created {out} ({size_str})")
-        self.clean_up()
-        self.reset_values()
-        dpg.configure_item(Tags.encode_button, enabled=True)
-        dpg.configure_item(Tags.queue_button, enabled=True)
+            size = sizes.get(out)
+            if size is None:
+                self.show_message(f"Failed to create {out}")
+            else:
+                self.show_message(f"Created {out} ({format_size(size)})")
 
     # Crop modal callbacks
 
@@ -303,14 +419,7 @@ class GuiHandler:
         dpg.configure_item(Tags.crop_confirm_button, enabled=False)
         einfo = self.current_file
 
-        if einfo.iratio > einfo.oratio:
-            w = einfo.iwidth
-            # stretch this by default
-            h = int(einfo.iwidth * einfo.ohscale)
-        else:
-            h = einfo.iheight
-            # stretch this by default
-            w = int(einfo.iheight * (einfo.owscale / einfo.ohscale))
+        w, h = einfo.crop_size()
         y = dpg.get_value(Tags.crop_y_slider)
         x = dpg.get_value(Tags.crop_x_slider)
         if y > einfo.iheight - h:
@@ -319,6 +428,7 @@ class GuiHandler:
             x = einfo.iwidth - w
         cropped_file = Encoder.crop(einfo.iname, w, h, x, y)
         self.cropped_filenames.append(cropped_file)
+        self.crop_rect = (w, h, x, y)
         dpg.set_value(
             Tags.preview_message,
             "File Cropped. Remember to close file after viewing so it can be removed during cleanup at the end",
@@ -329,13 +439,12 @@ class GuiHandler:
 
     def crop_confirm_callback(self):
         einfo = self.current_file
-        einfo.iname = self.cropped_filenames[-1]
-        einfo.iwidth, einfo.iheight = Encoder.get_dimensions(
-            self.cropped_filenames[-1]
-        )
+        # the cropped copy was only for the preview
+        einfo.crop_rect = self.crop_rect
+        einfo.set_dimensions(*self.crop_rect[:2])
         dpg.configure_item(Tags.crop_window, show=False)
         self.current_file = None
-        self.encode_callback()
+        self.process_crops()
 
     def print_value(self, sender, app_data, user_data):
         """For debugging"""
@@ -373,7 +482,9 @@ class GuiClient:
         if self.gh.STYLE:
             dpg.show_style_editor()
         while dpg.is_dearpygui_running():
+            self.gh.check_pending_filename()
             dpg.render_dearpygui_frame()
+        self.gh.probe_pool.shutdown(wait=True)
         dpg.destroy_context()
 
     def exit_message(self, message):
@@ -517,24 +628,42 @@ class GuiClient:
                 dpg.add_text(tag=t.preview_message, wrap=crop_width)
 
             # Output
-            dpg.add_input_text(
-                tag=t.messages,
-                multiline=True,
-                width=self.WIDTH,
-                readonly=True,
-            )
+            dpg.add_child_window(tag=t.messages, width=self.WIDTH, height=-1)
+
+
+REQUIRED_TOOLS = (
+    ("ffmpeg", "https://ffmpeg.org/"),
+    ("ffprobe", "https://ffmpeg.org/"),
+    ("ffplay", "https://ffmpeg.org/"),
+)
 
 
 def check_dependencies():
-    if not shutil.which("ffmpeg"):
-        return "ffmpeg is not installed. Please install ffmpeg from https://ffmpeg.org/"
-    if not shutil.which("ffprobe"):
-        return "ffprobe is not installed. Please install ffmpeg from https://ffmpeg.org/"
-    if not shutil.which("ffplay"):
-        return "ffplay is not installed. Please install ffmpeg from https://ffmpeg.org/"
+    """
+    Return a message for the first missing tool. Found tools are cached for
+    the current PATH so warm launches skip the PATH walk
+    """
+    found = which_cached(tool for tool, _ in REQUIRED_TOOLS)
+    for tool, url in REQUIRED_TOOLS:
+        if not found[tool]:
+            return f"{tool} is not installed. Please install ffmpeg from {url}"
+
+
+def setup_logging():
+    """Show encode progress. Set DISCORDGIFS_DEBUG to also show commands"""
+    debug = bool(os.environ.get("DISCORDGIFS_DEBUG"))
+    logging.basicConfig(
+        level=logging.DEBUG if debug else logging.INFO, format="%(message)s"
+    )
+
+
+def init_encode_worker(threads: int):
+    setup_logging()
+    ffmpeg_cmds.set_threads(threads)
 
 
 def main():
+    setup_logging()
     gh = GuiHandler()
     gh.dependency_message = check_dependencies()
     gui = GuiClient(gh)
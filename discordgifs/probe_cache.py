@@ -0,0 +1,72 @@
+import json
+import os
+import tempfile
+import threading
+from typing import Dict, Optional
+
+
+class ProbeCache:
+    """
+    ffprobe results kept in memory and in a json file in the user's cache
+    directory. Entries are keyed by real path and invalidated when the file's
+    mtime or size changes, or when schema differs from the one they were
+    saved with.
+    """
+
+    MAX_ENTRIES = 1000
+
+    def __init__(self, path: str, schema: str):
+        self.path = path
+        self.schema = schema
+        self._entries: Optional[Dict[str, dict]] = None
+        # the gui probes from its main thread and a worker thread
+        self._lock = threading.Lock()
+
+    def get(self, tar: str) -> Optional[Dict[str, str]]:
+        try:
+            key, stamp = self._key(tar)
+        except OSError:
+            return None
+        with self._lock:
+            entry = self._load().get(key)
+        if entry is None or entry["stamp"] != stamp:
+            return None
+        return entry["values"]
+
+    def put(self, tar: str, values: Dict[str, str]):
+        try:
+            key, stamp = self._key(tar)
+        except OSError:
+            return
+        with self._lock:
+            entries = self._load()
+            entries.pop(key, None)
+            entries[key] = {"stamp": stamp, "values": values}
+            while len(entries) > self.MAX_ENTRIES:
+                del entries[next(iter(entries))]
+            self._save()
+
+    def _key(self, tar: str):
+        st = os.stat(tar)
+        return os.path.realpath(tar), [st.st_mtime_ns, st.st_size, self.schema]
+
+    def _load(self) -> Dict[str, dict]:
+        if self._entries is None:
+            try:
+                with open(self.path, encoding="utf-8") as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError):
+                self._entries = dict()
+        return self._entries
+
+    def _save(self):
+        """Write the cache atomically. Failures only cost a future re-probe"""
+        dirname = os.path.dirname(self.path)
+        try:
+            os.makedirs(dirname, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(self._entries, f)
+            os.replace(tmp, self.path)
+        except OSError:
+            pass
@@ -1,28 +1,158 @@
-from typing import Optional
+from collections import defaultdict
+from typing import Dict, Iterable, Optional
+import hashlib
+import json
 import re
 import os
+import shutil
+import stat
+import sys
+import tempfile
 
-def get_available_name(name: str, ext: Optional[str] = None) -> str:
+_POSTFIX_RE = re.compile(r".+\((\d+)\).*")
+
+
+def get_available_name(
+    name: str, ext: Optional[str] = None, reserved: Iterable[str] = ()
+) -> str:
     """
-    Returns a file or folder name that is currently not in use.
+    Returns a file or folder name that is currently not in use. Paths in
+    reserved are treated as in use even if they don't exist yet.
     """
     if name == "":
         name = "temp"
-    postfix_pat = re.compile(r".+\((\d+)\).*")
     if os.path.isfile(name) and ext:
         ext = ext.replace(".", "")
         name = f"{os.path.splitext(name)[0]}.{ext}"
-    new_name = name
-    while os.path.exists(new_name):
-        match = re.search(postfix_pat, new_name)
-        if match:
-            new_num = int(match.groups()[-1]) + 1
-            new_name = (
-                new_name[: match.start(1)]
-                + str(new_num)
-                + new_name[match.end(1) :]
-            )
+
+    dirname, basename = os.path.split(name)
+    existing = {
+        os.path.normcase(os.path.basename(r))
+        for r in reserved
+        if os.path.dirname(r) == dirname
+    }
+    try:
+        # Read the directory once instead of probing each candidate
+        with os.scandir(dirname or ".") as entries:
+            existing.update(os.path.normcase(e.name) for e in entries)
+    except (FileNotFoundError, NotADirectoryError):
+        pass
+    if os.path.normcase(basename) not in existing:
+        return name
+
+    match = _POSTFIX_RE.search(basename)
+    if match:
+        prefix, suffix = basename[: match.start(1)], basename[match.end(1) :]
+        num = int(match.group(1)) + 1
+    else:
+        stem, ext = os.path.splitext(basename)
+        prefix, suffix = stem + "(", ")" + ext
+        num = 0
+    while os.path.normcase(f"{prefix}{num}{suffix}") in existing:
+        num += 1
+    return os.path.join(dirname, f"{prefix}{num}{suffix}")
+
+
+def get_file_sizes(paths: Iterable[str]) -> Dict[str, int]:
+    """
+    Returns a dict of path to size in bytes, scanning each parent directory
+    once rather than stat'ing every path. Paths are returned as given and
+    missing paths are left out.
+    """
+    # dirname -> basename -> the paths as given
+    by_dir = defaultdict(lambda: defaultdict(list))
+    for path in paths:
+        dirname, basename = os.path.split(path)
+        by_dir[dirname][basename].append(path)
+    sizes = dict()
+    for dirname, basenames in by_dir.items():
+        try:
+            with os.scandir(dirname or ".") as entries:
+                for e in entries:
+                    for path in basenames.get(e.name, ()):
+                        sizes[path] = e.stat().st_size
+        except (FileNotFoundError, NotADirectoryError):
+            pass
+    return sizes
+
+
+def remove_path(path: str) -> Optional[OSError]:
+    """
+    Removes a file or a whole folder. Returns the error instead of raising so
+    it can be used with Executor.map. A path that is already gone is fine.
+    """
+    try:
+        if stat.S_ISDIR(os.lstat(path).st_mode):
+            shutil.rmtree(path)
         else:
-            name, ext = os.path.splitext(new_name)
-            new_name = name + "(0)" + ext
-    return new_name
+            os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        return e
+    return None
+
+
+def format_size(size: int) -> str:
+    """Returns size in bytes as KB below a megabyte, otherwise as MB."""
+    if size < 1_000_000:
+        return f"{size / 1_000:.2f}KB"
+    return f"{size / 1_000_000:.2f}MB"
+
+
+def user_cache_dir() -> str:
+    """Returns the per-user cache directory for discordgifs."""
+    if sys.platform == "win32":
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+    elif sys.platform == "darwin":
+        base = os.path.expanduser("~/Library/Caches")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser(
+            "~/.cache"
+        )
+    return os.path.join(base, "discordgifs")
+
+
+def which_cached(tools: Iterable[str]) -> Dict[str, Optional[str]]:
+    """
+    Returns a dict of tool to its full path, or None if it isn't installed.
+    Lookups are saved in the user cache directory for the current PATH so
+    later launches only check that the saved paths still exist.
+    """
+    tools = list(tools)
+    cache_file = os.path.join(user_cache_dir(), "tools.json")
+    path_hash = hashlib.sha1(os.environ.get("PATH", "").encode()).hexdigest()
+    try:
+        with open(cache_file, encoding="utf-8") as f:
+            cache = json.load(f)
+        if cache["path_hash"] != path_hash:
+            cache = {"path_hash": path_hash, "tools": dict()}
+    except (OSError, ValueError, KeyError, TypeError):
+        cache = {"path_hash": path_hash, "tools": dict()}
+
+    found = dict()
+    before = dict(cache["tools"])
+    for tool in tools:
+        path = cache["tools"].get(tool)
+        if path is None or not os.path.isfile(path):
+            path = shutil.which(tool)
+            if path is None:
+                cache["tools"].pop(tool, None)
+            else:
+                cache["tools"][tool] = path
+        found[tool] = path
+
+    # missing tools aren't saved so they are found once installed. only write
+    # when something was found or went missing, not on every launch
+    if cache["tools"] != before:
+        # write atomically since encode workers may look tools up too
+        dirname = os.path.dirname(cache_file)
+        try:
+            os.makedirs(dirname, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(cache, f)
+            os.replace(tmp, cache_file)
+        except OSError:
+            pass
+    return found